@@ -1,20 +1,59 @@
 import sqlite3
+import threading
 from contextlib import contextmanager
+from typing import Optional
 
 class DatabaseConnection:
     def __init__(self, database_path: str = 'team_management.db'):
         self.database_path = database_path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self.open()
         self.setup_database()
 
+    def open(self) -> None:
+        """Open the shared connection if it isn't open already"""
+        if self._conn is not None:
+            return
+
+        conn = sqlite3.connect(
+            self.database_path,
+            check_same_thread=False,
+            cached_statements=256
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-64000")
+        conn.execute("PRAGMA wal_autocheckpoint=1000")
+        self._conn = conn
+
+    def close(self) -> None:
+        """Close the shared connection"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
     @contextmanager
     def get_connection(self):
-        conn = sqlite3.connect(self.database_path)
-        try:
-            yield conn
-        finally:
-            conn.close()
+        with self._lock:
+            self.open()
+            try:
+                yield self._conn
+            finally:
+                # The connection outlives the caller, so discard anything left
+                # uncommitted the way closing it used to
+                if self._conn.in_transaction:
+                    self._conn.rollback()
 
-    def setup_database(self):
+    def optimize(self) -> None:
+        """Let SQLite refresh query planner statistics"""
+        with self.get_connection() as conn:
+            conn.execute("PRAGMA optimize")
+
+    def setup_database(self) -> None:
         """Create necessary database tables if they don't exist"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
@@ -46,4 +85,56 @@ class DatabaseConnection:
                 )
             ''')
 
+            # Create notifications table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS notifications (
+                    team_name TEXT,
+                    username TEXT,
+                    chat_id INTEGER,
+                    sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (team_name) REFERENCES teams(team_name),
+                    PRIMARY KEY (team_name, username, chat_id)
+                )
+            ''')
+
+            # Create user_ids table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_ids (
+                    username TEXT NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # Older databases keyed user_ids on (username, user_id), so
+            # INSERT OR REPLACE piled up stale rows; keep the newest one
+            # per username before enforcing uniqueness
+            cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_user_ids_username'"
+            )
+            if not cursor.fetchone():
+                cursor.execute('''
+                    DELETE FROM user_ids WHERE rowid NOT IN (
+                        SELECT MAX(rowid) FROM user_ids GROUP BY username
+                    )
+                ''')
+                cursor.execute('''
+                    CREATE UNIQUE INDEX idx_user_ids_username
+                    ON user_ids (username)
+                ''')
+
+            # The primary keys lead with username/chat_id, so lookups by
+            # team_name need their own indexes
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_team_members_team
+                ON team_members (team_name)
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_chat_teams_team
+                ON chat_teams (team_name)
+            ''')
+
             conn.commit()
+
+            # Give the query planner statistics to pick the indexes with
+            cursor.execute("ANALYZE")
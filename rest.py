@@ -1,9 +1,25 @@
-from fastapi import FastAPI, HTTPException
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+from fastapi import Depends, FastAPI, HTTPException, Request
 from pydantic import BaseModel
-from .service import TeamManagementService
+from .service import TeamManagementService, normalize_team_name, normalize_username
 
-app = FastAPI()
-service = TeamManagementService()
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Own the service and its database connection for the app's lifetime"""
+    service = TeamManagementService()
+    app.state.service = service
+    try:
+        yield
+    finally:
+        service.db.optimize()
+        service.db.close()
+
+app = FastAPI(lifespan=lifespan)
+
+def get_service(request: Request) -> TeamManagementService:
+    return request.app.state.service
 
 class TeamCreate(BaseModel):
     team_name: str
@@ -17,36 +33,44 @@ class ChatTeam(BaseModel):
     team_name: str
 
 @app.post("/teams")
-async def create_team(team: TeamCreate):
-    result = service.create_team(team.team_name)
+async def create_team(team: TeamCreate, service: TeamManagementService = Depends(get_service)):
+    result = await asyncio.to_thread(service.create_team, normalize_team_name(team.team_name))
     if not result["success"]:
         raise HTTPException(status_code=400, detail=result["message"])
     return result
 
 @app.post("/teams/members")
-async def add_team_member(member: TeamMember):
-    result = service.add_member_to_team(member.username, member.team_name)
+async def add_team_member(member: TeamMember, service: TeamManagementService = Depends(get_service)):
+    result = await asyncio.to_thread(
+        service.add_member_to_team,
+        normalize_username(member.username), normalize_team_name(member.team_name)
+    )
     if not result["success"]:
         raise HTTPException(status_code=400, detail=result["message"])
     return result
 
 @app.delete("/teams/members")
-async def remove_team_member(member: TeamMember):
-    result = service.remove_member_from_team(member.username, member.team_name)
+async def remove_team_member(member: TeamMember, service: TeamManagementService = Depends(get_service)):
+    result = await asyncio.to_thread(
+        service.remove_member_from_team,
+        normalize_username(member.username), normalize_team_name(member.team_name)
+    )
     if not result["success"]:
         raise HTTPException(status_code=400, detail=result["message"])
     return result
 
 @app.post("/chats/teams")
-async def add_team_to_chat(chat_team: ChatTeam):
-    result = service.add_team_to_chat(chat_team.chat_id, chat_team.team_name)
+async def add_team_to_chat(chat_team: ChatTeam, service: TeamManagementService = Depends(get_service)):
+    result = await asyncio.to_thread(
+        service.add_team_to_chat, chat_team.chat_id, normalize_team_name(chat_team.team_name)
+    )
     if not result["success"]:
         raise HTTPException(status_code=400, detail=result["message"])
     return result
 
 @app.delete("/users/{username}")
-async def offboard_user(username: str):
-    result = service.offboard_user(username)
+async def offboard_user(username: str, service: TeamManagementService = Depends(get_service)):
+    result = await asyncio.to_thread(service.offboard_user, normalize_username(username))
     if not result["success"]:
         raise HTTPException(status_code=400, detail=result["message"])
     return result
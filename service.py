@@ -1,32 +1,64 @@
 from typing import List, Dict, Union
+import json
 import logging
 import sqlite3
-from contextlib import contextmanager
 
-ServiceResponse = Dict[str, Union[bool, str, List[int]]]
+# rest.py imports this module as part of a package, main.py as a top-level module
+try:
+    from .database import DatabaseConnection
+except ImportError:
+    from database import DatabaseConnection
+
+ServiceResponse = Dict[str, Union[bool, str, List[int], Dict[str, List[int]]]]
+
+# Service methods expect names that already went through these
+_STRIP_AT = str.maketrans("", "", "@")
+
+def normalize_username(username: str) -> str:
+    """Canonical form of a username: no '@', lowercase"""
+    return username.translate(_STRIP_AT).lower()
+
+def normalize_team_name(team_name: str) -> str:
+    """Canonical form of a team name: lowercase"""
+    return team_name.lower()
 
 class TeamManagementService:
     def __init__(self, database_path: str = 'team_management.db'):
         self.db = DatabaseConnection(database_path)
         self.logger = logging.getLogger(__name__)
 
+    def _team_chats(self, cursor: sqlite3.Cursor, team_name: str) -> List[int]:
+        """Get all chats where the team is present"""
+        cursor.execute(
+            "SELECT chat_id FROM chat_teams WHERE team_name = ?",
+            (team_name,)
+        )
+        return [row[0] for row in cursor]
+
+    def _team_exists(self, cursor: sqlite3.Cursor, team_name: str) -> bool:
+        """Check whether a team exists, for telling apart why an insert was skipped"""
+        cursor.execute("SELECT 1 FROM teams WHERE team_name = ?", (team_name,))
+        return cursor.fetchone() is not None
+
     def create_team(self, team_name: str) -> ServiceResponse:
         """Create a new team"""
-        team_name = team_name.lower()
         try:
             with self.db.get_connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute("INSERT INTO teams (team_name) VALUES (?)", (team_name,))
+                cursor.execute(
+                    "INSERT INTO teams (team_name) VALUES (?) ON CONFLICT DO NOTHING",
+                    (team_name,)
+                )
+                if cursor.rowcount == 0:
+                    return {
+                        "success": False,
+                        "message": f"Team {team_name!r} already exists"
+                    }
                 conn.commit()
             return {
                 "success": True,
                 "message": f"Team {team_name!r} created successfully"
             }
-        except sqlite3.IntegrityError:
-            return {
-                "success": False,
-                "message": f"Team {team_name!r} already exists"
-            }
         except Exception as e:
             self.logger.error(f"Error creating team: {str(e)}")
             return {
@@ -36,9 +68,46 @@ class TeamManagementService:
 
     def add_member_to_team(self, username: str, team_name: str) -> ServiceResponse:
         """Add a member to a team"""
-        username = username.replace("@", "")
-        team_name = team_name.lower()
+        try:
+            with self.db.get_connection() as conn:
+                cursor = conn.cursor()
+
+                # Insert only if the team exists
+                cursor.execute(
+                    """
+                    INSERT INTO team_members (username, team_name)
+                    SELECT ?, ? WHERE EXISTS (SELECT 1 FROM teams WHERE team_name = ?)
+                    ON CONFLICT DO NOTHING
+                    """,
+                    (username, team_name, team_name)
+                )
+                if cursor.rowcount == 0:
+                    if not self._team_exists(cursor, team_name):
+                        return {
+                            "success": False,
+                            "message": f"Team {team_name!r} doesn't exist"
+                        }
+                    return {
+                        "success": False,
+                        "message": f"User {username!r} is already in team {team_name!r}"
+                    }
+                conn.commit()
+
+                return {
+                    "success": True,
+                    "message": f"Added user {username!r} to team {team_name!r}",
+                    "chats_to_add": self._team_chats(cursor, team_name)
+                }
+
+        except Exception as e:
+            self.logger.error(f"Error adding member to team: {str(e)}")
+            return {
+                "success": False,
+                "message": "Internal server error"
+            }
 
+    def add_members_to_team(self, usernames: List[str], team_name: str) -> ServiceResponse:
+        """Add several members to a team in a single transaction"""
         try:
             with self.db.get_connection() as conn:
                 cursor = conn.cursor()
@@ -51,32 +120,22 @@ class TeamManagementService:
                         "message": f"Team {team_name!r} doesn't exist"
                     }
 
-                cursor.execute(
-                    "INSERT INTO team_members (username, team_name) VALUES (?, ?)",
-                    (username, team_name)
-                )
-                conn.commit()
-
-                # Get all chats where the team is present
-                cursor.execute(
-                    "SELECT chat_id FROM chat_teams WHERE team_name = ?",
-                    (team_name,)
-                )
-                chats = cursor.fetchall()
+                # One commit for the whole batch
+                with conn:
+                    cursor.executemany(
+                        "INSERT OR IGNORE INTO team_members (username, team_name) VALUES (?, ?)",
+                        [(username, team_name) for username in usernames]
+                    )
+                added = cursor.rowcount
 
                 return {
                     "success": True,
-                    "message": f"Added user {username!r} to team {team_name!r}",
-                    "chats_to_add": [chat[0] for chat in chats]
+                    "message": f"Added {added} user(s) to team {team_name!r}",
+                    "chats_to_add": self._team_chats(cursor, team_name)
                 }
 
-        except sqlite3.IntegrityError:
-            return {
-                "success": False,
-                "message": f"User {username!r} is already in team {team_name!r}"
-            }
         except Exception as e:
-            self.logger.error(f"Error adding member to team: {str(e)}")
+            self.logger.error(f"Error adding members to team: {str(e)}")
             return {
                 "success": False,
                 "message": "Internal server error"
@@ -84,9 +143,6 @@ class TeamManagementService:
 
     def remove_member_from_team(self, username: str, team_name: str) -> ServiceResponse:
         """Remove a member from a team"""
-        username = username.replace("@", "")
-        team_name = team_name.lower()
-
         try:
             with self.db.get_connection() as conn:
                 cursor = conn.cursor()
@@ -104,17 +160,10 @@ class TeamManagementService:
 
                 conn.commit()
 
-                # Get all chats where the team is present
-                cursor.execute(
-                    "SELECT chat_id FROM chat_teams WHERE team_name = ?",
-                    (team_name,)
-                )
-                chats = cursor.fetchall()
-
                 return {
                     "success": True,
                     "message": f"Removed user {username!r} from team {team_name!r}",
-                    "chats_to_remove": [chat[0] for chat in chats]
+                    "chats_to_remove": self._team_chats(cursor, team_name)
                 }
 
         except Exception as e:
@@ -126,25 +175,29 @@ class TeamManagementService:
 
     def add_team_to_chat(self, chat_id: int, team_name: str) -> ServiceResponse:
         """Add a team to a chat"""
-        team_name = team_name.lower()
-
         try:
             with self.db.get_connection() as conn:
                 cursor = conn.cursor()
 
-                # Check if team exists
-                cursor.execute("SELECT team_name FROM teams WHERE team_name = ?", (team_name,))
-                if not cursor.fetchone():
+                # Add team to chat if the team exists
+                cursor.execute(
+                    """
+                    INSERT INTO chat_teams (chat_id, team_name)
+                    SELECT ?, ? WHERE EXISTS (SELECT 1 FROM teams WHERE team_name = ?)
+                    ON CONFLICT DO NOTHING
+                    """,
+                    (chat_id, team_name, team_name)
+                )
+                if cursor.rowcount == 0:
+                    if not self._team_exists(cursor, team_name):
+                        return {
+                            "success": False,
+                            "message": f"Team {team_name!r} doesn't exist"
+                        }
                     return {
                         "success": False,
-                        "message": f"Team {team_name!r} doesn't exist"
+                        "message": f"Team {team_name!r} is already in this chat"
                     }
-
-                # Add team to chat
-                cursor.execute(
-                    "INSERT INTO chat_teams (chat_id, team_name) VALUES (?, ?)",
-                    (chat_id, team_name)
-                )
                 conn.commit()
 
                 # Get all team members
@@ -152,19 +205,14 @@ class TeamManagementService:
                     "SELECT username FROM team_members WHERE team_name = ?",
                     (team_name,)
                 )
-                members = cursor.fetchall()
+                members = [row[0] for row in cursor]
 
                 return {
                     "success": True,
                     "message": f"Added team {team_name!r} to chat",
-                    "members_to_add": [member[0] for member in members]
+                    "members_to_add": members
                 }
 
-        except sqlite3.IntegrityError:
-            return {
-                "success": False,
-                "message": f"Team {team_name!r} is already in this chat"
-            }
         except Exception as e:
             self.logger.error(f"Error adding team to chat: {str(e)}")
             return {
@@ -174,45 +222,38 @@ class TeamManagementService:
 
     def offboard_user(self, username: str) -> ServiceResponse:
         """Remove a user from all teams and associated chats"""
-        username = username.replace("@", "")
-
         try:
             with self.db.get_connection() as conn:
                 cursor = conn.cursor()
 
-                # Get all chats the user needs to be removed from
+                # Remove user from all teams; each returned row carries the
+                # chats of one of those teams, so one statement does both
                 cursor.execute(
                     """
-                    SELECT DISTINCT chat_id
-                    FROM chat_teams
-                    WHERE team_name IN (
-                        SELECT team_name
-                        FROM team_members
-                        WHERE username = ?
+                    DELETE FROM team_members WHERE username = ?
+                    RETURNING (
+                        SELECT json_group_array(chat_id)
+                        FROM chat_teams
+                        WHERE chat_teams.team_name = team_members.team_name
                     )
                     """,
                     (username,)
                 )
-                chats = cursor.fetchall()
-
-                # Remove user from all teams
-                cursor.execute(
-                    "DELETE FROM team_members WHERE username = ?",
-                    (username,)
-                )
+                team_chats = [json.loads(row[0]) for row in cursor]
 
-                if cursor.rowcount == 0:
+                if not team_chats:
                     return {
                         "success": False,
                         "message": f"User {username!r} is not in any teams"
                     }
 
                 conn.commit()
+                chats = sorted({chat_id for chat_ids in team_chats for chat_id in chat_ids})
 
                 return {
                     "success": True,
                     "message": f"User {username!r} has been offboarded",
-                    "chats_to_remove": [chat[0] for chat in chats]
+                    "chats_to_remove": chats
                 }
 
         except Exception as e:
@@ -222,29 +263,98 @@ class TeamManagementService:
                 "message": "Internal server error"
             }
 
-    def get_team_members(self, team_name: str) -> List[str]:
-        """Get all members of a team"""
-        team_name = team_name.lower()
+    def offboard_users(self, usernames: List[str]) -> ServiceResponse:
+        """Remove several users from all teams in a single transaction"""
+        if not usernames:
+            return {
+                "success": False,
+                "message": "No users to offboard"
+            }
 
-        with self.db.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT username FROM team_members WHERE team_name = ?",
-                (team_name,)
-            )
-            return [row[0] for row in cursor.fetchall()]
+        placeholders = ",".join("?" * len(usernames))
+
+        try:
+            with self.db.get_connection() as conn:
+                cursor = conn.cursor()
+
+                with conn:
+                    # Take the write lock up front so the lookup and the
+                    # delete see the same memberships
+                    cursor.execute("BEGIN IMMEDIATE")
+
+                    # Get all chats each user needs to be removed from
+                    cursor.execute(
+                        f"""
+                        SELECT DISTINCT chat_id, username
+                        FROM chat_teams
+                        JOIN team_members USING (team_name)
+                        WHERE username IN ({placeholders})
+                        """,
+                        usernames
+                    )
+                    rows = cursor.fetchall()
+
+                    # Remove users from all teams
+                    cursor.execute(
+                        f"DELETE FROM team_members WHERE username IN ({placeholders})",
+                        usernames
+                    )
+                    removed = cursor.rowcount
+
+                if removed == 0:
+                    return {
+                        "success": False,
+                        "message": "None of these users are in any teams"
+                    }
+
+                chats_to_remove: Dict[str, List[int]] = {}
+                for chat_id, username in rows:
+                    chats_to_remove.setdefault(username, []).append(chat_id)
+
+                return {
+                    "success": True,
+                    "message": "Users have been offboarded",
+                    "chats_to_remove": chats_to_remove
+                }
+
+        except Exception as e:
+            self.logger.error(f"Error offboarding users: {str(e)}")
+            return {
+                "success": False,
+                "message": "Internal server error"
+            }
+
+    def mark_notifications_sent(self, chat_id: int, team_name: str, usernames: List[str]) -> ServiceResponse:
+        """Record that team members were told about a chat, in a single transaction"""
+        try:
+            with self.db.get_connection() as conn:
+                with conn:
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO notifications (team_name, username, chat_id) VALUES (?, ?, ?)",
+                        [(team_name, username, chat_id) for username in usernames]
+                    )
+
+            return {
+                "success": True,
+                "message": f"Recorded {len(usernames)} notification(s) for team {team_name!r}"
+            }
+
+        except Exception as e:
+            self.logger.error(f"Error recording notifications: {str(e)}")
+            return {
+                "success": False,
+                "message": "Internal server error"
+            }
 
     def get_user_teams(self, username: str) -> List[str]:
         """Get all teams a user belongs to"""
-        username = username.replace("@", "")
-
         with self.db.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "SELECT team_name FROM team_members WHERE username = ?",
                 (username,)
             )
-            return [row[0] for row in cursor.fetchall()]
+            return [row[0] for row in cursor]
 
     def get_chat_teams(self, chat_id: int) -> List[str]:
         """Get all teams in a chat"""
@@ -254,7 +364,7 @@ class TeamManagementService:
                 "SELECT team_name FROM chat_teams WHERE chat_id = ?",
                 (chat_id,)
             )
-            return [row[0] for row in cursor.fetchall()]
+            return [row[0] for row in cursor]
 
     def get_teams(self) -> List[str]:
         """Get all teams"""
@@ -263,62 +373,14 @@ class TeamManagementService:
             cursor.execute(
                 "SELECT team_name FROM teams ORDER BY team_name"
             )
-            return [row[0] for row in cursor.fetchall()]
+            return [row[0] for row in cursor]
 
     def get_team_members(self, team_name: str) -> List[str]:
         """Get all members of a team"""
-        team_name = team_name.lower()
         with self.db.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "SELECT username FROM team_members WHERE team_name = ? ORDER BY username",
                 (team_name,)
             )
-            return [row[0] for row in cursor.fetchall()]
-
-class DatabaseConnection:
-    def __init__(self, database_path: str):
-        self.database_path = database_path
-        self.setup_database()
-
-    @contextmanager
-    def get_connection(self):
-        conn = sqlite3.connect(self.database_path)
-        try:
-            yield conn
-        finally:
-            conn.close()
-
-    def setup_database(self) -> None:
-        """Create necessary database tables if they don't exist"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-
-            # Create teams table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS teams (
-                    team_name TEXT PRIMARY KEY
-                )
-            ''')
-
-            # Create team_members table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS team_members (
-                    username TEXT,
-                    team_name TEXT,
-                    FOREIGN KEY (team_name) REFERENCES teams(team_name),
-                    PRIMARY KEY (username, team_name)
-                )
-            ''')
-
-            # Create chat_teams table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS chat_teams (
-                    chat_id INTEGER,
-                    team_name TEXT,
-                    FOREIGN KEY (team_name) REFERENCES teams(team_name),
-                    PRIMARY KEY (chat_id, team_name)
-                )
-            ''')
-
-            conn.commit()
+            return [row[0] for row in cursor]
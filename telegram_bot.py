@@ -1,32 +1,82 @@
 from telegram import Update
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
 from telegram.error import BadRequest
-from service import TeamManagementService
+from service import ServiceResponse, TeamManagementService, normalize_team_name, normalize_username
+import asyncio
 import logging
-from typing import NoReturn, Optional, Dict
-import sqlite3
+from typing import Awaitable, Callable, NamedTuple, NoReturn, Optional, Dict, Tuple
+
+class MemberCommand(NamedTuple):
+    """How a command that changes a user's memberships is handled"""
+    usage: str
+    arg_count: int
+    unknown_user: str
+    service_method: Callable[..., ServiceResponse]
+    chats_key: str
+    # (update, context, chat_id, user_id, username, team_name) -> failed chat or None
+    chat_action: Callable[..., Awaitable[Optional[str]]]
+    failure_note: Optional[str]
 
 class TeamManagementBot:
+    # Buffered user IDs are written out every interval or once this many pile up
+    USER_CACHE_FLUSH_INTERVAL = 5
+    USER_CACHE_FLUSH_THRESHOLD = 100
+    # How often SQLite gets to refresh its query planner statistics
+    DB_OPTIMIZE_INTERVAL = 15 * 60
+
     def __init__(self, token: str, service: TeamManagementService) -> None:
         self.token = token
         self.service = service
         self.logger = logging.getLogger(__name__)
         self.user_id_cache: Dict[str, int] = {}
+        self._pending_cache: Dict[str, int] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._optimize_task: Optional[asyncio.Task] = None
+        # Caps concurrent Telegram API calls to stay under rate limits
+        self.api_semaphore = asyncio.Semaphore(20)
+        self._member_commands: Dict[str, MemberCommand] = {
+            "add_to_team": MemberCommand(
+                usage="Usage: /add_to_team @username team_name",
+                arg_count=2,
+                unknown_user=(
+                    "I don't know user {username} yet! Please ask them to:\n"
+                    "1. Start a chat with me (@{bot_username})\n"
+                    "2. Send me any message\n"
+                    "Then try adding them to the team again."
+                ),
+                service_method=self.service.add_member_to_team,
+                chats_key="chats_to_add",
+                chat_action=self._invite_to_chat,
+                failure_note=None
+            ),
+            "remove_from_team": MemberCommand(
+                usage="Usage: /remove_from_team @username team_name",
+                arg_count=2,
+                unknown_user="I don't know user {username}! They need to start a chat with me first.",
+                service_method=self.service.remove_member_from_team,
+                chats_key="chats_to_remove",
+                chat_action=self._kick,
+                failure_note=None
+            ),
+            "offboard": MemberCommand(
+                usage="Usage: /offboard @username",
+                arg_count=1,
+                unknown_user="I don't know user {username}! They need to start a chat with me first.",
+                service_method=self.service.offboard_user,
+                chats_key="chats_to_remove",
+                chat_action=self._kick,
+                failure_note="Failed to remove from some chats"
+            ),
+        }
         self.setup_user_cache()
 
     def setup_user_cache(self) -> None:
-        """Setup user ID cache table"""
-        with sqlite3.connect(self.service.db.database_path) as conn:
+        """Load the user ID cache from the database"""
+        with self.service.db.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS user_ids (
-                    username TEXT,
-                    user_id INTEGER NOT NULL,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    PRIMARY KEY (username, user_id)
-                )
-            ''')
-            conn.commit()
+            # Lookups are served from memory from here on
+            cursor.execute('SELECT username, user_id FROM user_ids')
+            self.user_id_cache = dict(cursor)
 
     async def cache_user_id(self, username: str, user_id: int) -> None:
         """Store user ID in cache"""
@@ -34,33 +84,61 @@ class TeamManagementBot:
             return
 
         self.user_id_cache[username] = user_id
-        with sqlite3.connect(self.service.db.database_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT OR REPLACE INTO user_ids (username, user_id)
-                VALUES (?, ?)
-            ''', (username, user_id))
-            conn.commit()
+        self._pending_cache[username] = user_id
+        if len(self._pending_cache) >= self.USER_CACHE_FLUSH_THRESHOLD:
+            await self.flush_user_cache()
+
+    def _write_user_ids(self, user_ids: Dict[str, int]) -> None:
+        """Write user IDs to the database in a single transaction"""
+        with self.service.db.get_connection() as conn:
+            with conn:
+                conn.executemany('''
+                    INSERT INTO user_ids (username, user_id)
+                    VALUES (?, ?)
+                    ON CONFLICT (username) DO UPDATE
+                    SET user_id = excluded.user_id, updated_at = CURRENT_TIMESTAMP
+                ''', user_ids.items())
+
+    async def flush_user_cache(self) -> None:
+        """Persist buffered user IDs without blocking the event loop"""
+        if not self._pending_cache:
+            return
+
+        # Swap the buffer here on the loop so the worker thread owns its snapshot
+        pending, self._pending_cache = self._pending_cache, {}
+        try:
+            await asyncio.to_thread(self._write_user_ids, pending)
+        except Exception as e:
+            self.logger.error(f"Failed to persist user ID cache: {str(e)}")
+            # Keep anything newer that arrived meanwhile, retry the rest later
+            for username, user_id in pending.items():
+                self._pending_cache.setdefault(username, user_id)
+
+    async def _flush_loop(self) -> NoReturn:
+        """Periodically persist buffered user IDs"""
+        while True:
+            await asyncio.sleep(self.USER_CACHE_FLUSH_INTERVAL)
+            await self.flush_user_cache()
+
+    async def _optimize_loop(self) -> NoReturn:
+        """Periodically let SQLite refresh query planner statistics"""
+        while True:
+            await asyncio.sleep(self.DB_OPTIMIZE_INTERVAL)
+            try:
+                await asyncio.to_thread(self.service.db.optimize)
+            except Exception as e:
+                # Try again next interval rather than ending the loop
+                self.logger.error(f"Failed to optimize database: {str(e)}")
 
     def get_cached_user_id(self, username: str) -> Optional[int]:
         """Get user ID from cache"""
-        if username in self.user_id_cache:
-            return self.user_id_cache[username]
-
-        with sqlite3.connect(self.service.db.database_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT user_id FROM user_ids WHERE username = ?', (username,))
-            result = cursor.fetchone()
-            if result:
-                self.user_id_cache[username] = result[0]
-                return result[0]
-        return None
+        return self.user_id_cache.get(username)
 
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle any message to capture user information"""
         if update.effective_user and update.effective_user.username:
             await self.cache_user_id(
-                update.effective_user.username.lower(),
+                normalize_username(update.effective_user.username),
                 update.effective_user.id
             )
 
@@ -71,7 +149,7 @@ class TeamManagementBot:
 
         if update.effective_user.username:
             await self.cache_user_id(
-                update.effective_user.username.lower(),
+                normalize_username(update.effective_user.username),
                 update.effective_user.id
             )
 
@@ -98,106 +176,154 @@ For users to be added to teams, they should:
 
     async def get_user_id(self, username: str, context: ContextTypes.DEFAULT_TYPE) -> Optional[int]:
         """Get user ID through multiple methods"""
-        clean_username = username.lstrip('@').lower()
+        clean_username = normalize_username(username)
 
         cached_id = self.get_cached_user_id(clean_username)
         if cached_id:
             return cached_id
         return None
 
+    async def _invite_to_chat(
+        self,
+        update: Update,
+        context: ContextTypes.DEFAULT_TYPE,
+        chat_id: int,
+        user_id: int,
+        username: str,
+        team_name: Optional[str] = None
+    ) -> Optional[str]:
+        """Send a user the link to one of their team's chats"""
+        async with self.api_semaphore:
+            try:
+                chat = await context.bot.get_chat(chat_id)
+                if chat.username:  # Public chat
+                    chat_link = f"https://t.me/{chat.username}"
+                else:  # Private chat
+                    invite = await chat.create_invite_link()
+                    chat_link = invite.invite_link
+
+                try:
+                    await context.bot.send_message(
+                        user_id,
+                        f"You've been added to team {team_name}! Join the chat here: {chat_link}"
+                    )
+                except Exception as e:
+                    self.logger.error(f"Couldn't send direct message to user: {str(e)}")
+                    if update.effective_message:
+                        await update.effective_message.reply_text(
+                            f"Please share this link with {username}: {chat_link}"
+                        )
+            except Exception as e:
+                self.logger.error(f"Failed to create invite for chat {chat_id!r}: {str(e)}")
+                return str(chat_id)
+        return None
+
+    async def _notify_added(
+        self,
+        context: ContextTypes.DEFAULT_TYPE,
+        username: str,
+        team_name: str,
+        chat_link: str
+    ) -> Optional[str]:
+        """Tell a team member about a new chat, returning their username on failure"""
+        user_id = await self.get_user_id(username, context)
+        if not user_id:
+            return username
+
+        async with self.api_semaphore:
+            try:
+                await context.bot.send_message(
+                    user_id,
+                    f"Team {team_name} has been added to a new chat! Join here: {chat_link}"
+                )
+            except Exception as e:
+                self.logger.error(f"Failed to notify user {username}: {str(e)}")
+                return username
+        return None
+
+    async def _kick(
+        self,
+        update: Update,
+        context: ContextTypes.DEFAULT_TYPE,
+        chat_id: int,
+        user_id: int,
+        username: str,
+        team_name: Optional[str] = None
+    ) -> Optional[str]:
+        """Remove a user from a chat, returning the chat id on failure"""
+        async with self.api_semaphore:
+            try:
+                await context.bot.ban_chat_member(
+                    chat_id=chat_id,
+                    user_id=user_id
+                )
+                await context.bot.unban_chat_member(
+                    chat_id=chat_id,
+                    user_id=user_id
+                )
+            except Exception as e:
+                self.logger.error(f"Failed to remove user from chat {chat_id!r}: {str(e)}")
+                return str(chat_id)
+        return None
+
     async def create_team(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle /create_team command"""
         if not context.args or not update.effective_message:
             await update.effective_message.reply_text("Usage: /create_team <team_name>")
             return
 
-        team_name = context.args[0].lower()
-        result = self.service.create_team(team_name)
+        team_name = normalize_team_name(context.args[0])
+        result = await asyncio.to_thread(self.service.create_team, team_name)
         await update.effective_message.reply_text(str(result["message"]))
 
-    async def add_to_team(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        """Handle /add_to_team command"""
-        if not context.args or len(context.args) != 2 or not update.effective_message:
-            await update.effective_message.reply_text("Usage: /add_to_team @username team_name")
+    def _resolve_user(self, username: str) -> Tuple[str, Optional[int]]:
+        """Normalize a username and look up its cached user ID"""
+        clean_username = normalize_username(username)
+        return clean_username, self.get_cached_user_id(clean_username)
+
+    async def _member_cmd(
+        self,
+        update: Update,
+        context: ContextTypes.DEFAULT_TYPE,
+        command: str
+    ) -> None:
+        """Shared flow for commands that change a user's team memberships"""
+        spec = self._member_commands[command]
+        if not context.args or len(context.args) != spec.arg_count or not update.effective_message:
+            await update.effective_message.reply_text(spec.usage)
             return
 
-        username, team_name = context.args[0], context.args[1]
-        clean_username = username.lstrip('@').lower()
-
-        user_id = await self.get_user_id(username, context)
+        username, *rest = context.args
+        rest = [normalize_team_name(team_name) for team_name in rest]
+        clean_username, user_id = self._resolve_user(username)
         if not user_id:
             await update.effective_message.reply_text(
-                f"I don't know user {username} yet! Please ask them to:\n"
-                f"1. Start a chat with me (@{context.bot.username})\n"
-                f"2. Send me any message\n"
-                f"Then try adding them to the team again."
+                spec.unknown_user.format(username=username, bot_username=context.bot.username)
             )
             return
 
-        result = self.service.add_member_to_team(clean_username, team_name)
+        result = await asyncio.to_thread(spec.service_method, clean_username, *rest)
+        response = str(result["message"])
 
         if result["success"]:
-            chats_to_add = result.get("chats_to_add", [])
-            for chat_id in chats_to_add:
-                try:
-                    chat = await context.bot.get_chat(chat_id)
-                    if chat.username:  # Public chat
-                        chat_link = f"https://t.me/{chat.username}"
-                    else:  # Private chat
-                        invite = await chat.create_invite_link()
-                        chat_link = invite.invite_link
-
-                    try:
-                        await context.bot.send_message(
-                            user_id,
-                            f"You've been added to team {team_name}! Join the chat here: {chat_link}"
-                        )
-                    except Exception as e:
-                        self.logger.error(f"Couldn't send direct message to user: {str(e)}")
-                        if update.effective_message:
-                            await update.effective_message.reply_text(
-                                f"Please share this link with {username}: {chat_link}"
-                            )
-                except Exception as e:
-                    self.logger.error(f"Failed to create invite for chat {chat_id!r}: {str(e)}")
+            team_name = rest[0] if rest else None
+            results = await asyncio.gather(*(
+                spec.chat_action(update, context, chat_id, user_id, username, team_name)
+                for chat_id in result.get(spec.chats_key, [])
+            ))
+            failed_chats = [chat_id for chat_id in results if chat_id]
+            if spec.failure_note and failed_chats:
+                response += f"\n{spec.failure_note}: {', '.join(failed_chats)}"
 
-        if update.effective_message:
-            await update.effective_message.reply_text(str(result["message"]))
+        await update.effective_message.reply_text(response)
+
+    async def add_to_team(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Handle /add_to_team command"""
+        await self._member_cmd(update, context, "add_to_team")
 
     async def remove_from_team(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle /remove_from_team command"""
-        if not context.args or len(context.args) != 2 or not update.effective_message:
-            await update.effective_message.reply_text("Usage: /remove_from_team @username team_name")
-            return
-
-        username, team_name = context.args[0], context.args[1]
-        clean_username = username.lstrip('@').lower()
-
-        user_id = await self.get_user_id(username, context)
-        if not user_id:
-            await update.effective_message.reply_text(
-                f"I don't know user {username}! They need to start a chat with me first."
-            )
-            return
-
-        result = self.service.remove_member_from_team(clean_username, team_name)
-
-        if result["success"]:
-            chats_to_remove = result.get("chats_to_remove", [])
-            for chat_id in chats_to_remove:
-                try:
-                    await context.bot.ban_chat_member(
-                        chat_id=chat_id,
-                        user_id=user_id
-                    )
-                    await context.bot.unban_chat_member(
-                        chat_id=chat_id,
-                        user_id=user_id
-                    )
-                except Exception as e:
-                    self.logger.error(f"Failed to remove user from chat {chat_id!r}: {str(e)}")
-
-        await update.effective_message.reply_text(str(result["message"]))
+        await self._member_cmd(update, context, "remove_from_team")
 
     async def add_team_to_chat(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle /add command"""
@@ -205,12 +331,13 @@ For users to be added to teams, they should:
             await update.effective_message.reply_text("Usage: /add team_name")
             return
 
-        team_name = context.args[0].lower()
-        result = self.service.add_team_to_chat(update.effective_chat.id, team_name)
+        team_name = normalize_team_name(context.args[0])
+        result = await asyncio.to_thread(
+            self.service.add_team_to_chat, update.effective_chat.id, team_name
+        )
 
         if result["success"]:
             members_to_add = result.get("members_to_add", [])
-            failed_members = []
 
             try:
                 chat = await context.bot.get_chat(update.effective_chat.id)
@@ -220,19 +347,17 @@ For users to be added to teams, they should:
                     invite = await chat.create_invite_link()
                     chat_link = invite.invite_link
 
-                for username in members_to_add:
-                    user_id = await self.get_user_id(username, context)
-                    if user_id:
-                        try:
-                            await context.bot.send_message(
-                                user_id,
-                                f"Team {team_name} has been added to a new chat! Join here: {chat_link}"
-                            )
-                        except Exception as e:
-                            failed_members.append(username)
-                            self.logger.error(f"Failed to notify user {username}: {str(e)}")
-                    else:
-                        failed_members.append(username)
+                results = await asyncio.gather(*(
+                    self._notify_added(context, username, team_name, chat_link)
+                    for username in members_to_add
+                ))
+                failed_members = [username for username in results if username]
+                notified = [username for username in members_to_add if username not in failed_members]
+                if notified:
+                    await asyncio.to_thread(
+                        self.service.mark_notifications_sent,
+                        update.effective_chat.id, team_name, notified
+                    )
 
                 response = str(result["message"])
                 if failed_members:
@@ -246,52 +371,14 @@ For users to be added to teams, they should:
 
     async def offboard_user(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle /offboard command"""
-        if not context.args or not update.effective_message:
-            await update.effective_message.reply_text("Usage: /offboard @username")
-            return
-
-        username = context.args[0]
-        clean_username = username.lstrip('@').lower()
-
-        user_id = await self.get_user_id(username, context)
-        if not user_id:
-            await update.effective_message.reply_text(
-                f"I don't know user {username}! They need to start a chat with me first."
-            )
-            return
-
-        result = self.service.offboard_user(clean_username)
-
-        if result["success"]:
-            chats_to_remove = result.get("chats_to_remove", [])
-            failed_chats = []
-
-            for chat_id in chats_to_remove:
-                try:
-                    await context.bot.ban_chat_member(
-                        chat_id=chat_id,
-                        user_id=user_id
-                    )
-                    await context.bot.unban_chat_member(
-                        chat_id=chat_id,
-                        user_id=user_id
-                    )
-                except Exception as e:
-                    failed_chats.append(str(chat_id))
-                    self.logger.error(f"Failed to remove user from chat {chat_id!r}: {str(e)}")
-
-            response = str(result["message"])
-            if failed_chats:
-                response += f"\nFailed to remove from some chats: {', '.join(failed_chats)}"
-
-            await update.effective_message.reply_text(response)
+        await self._member_cmd(update, context, "offboard")
 
     async def list_teams(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle /list_teams command"""
         if not update.effective_message:
             return
 
-        teams = self.service.get_teams()
+        teams = await asyncio.to_thread(self.service.get_teams)
         if not teams:
             await update.effective_message.reply_text("No teams exist yet!")
             return
@@ -305,8 +392,8 @@ For users to be added to teams, they should:
             await update.effective_message.reply_text("Usage: /list_members team_name")
             return
 
-        team_name = context.args[0].lower()
-        members = self.service.get_team_members(team_name)
+        team_name = normalize_team_name(context.args[0])
+        members = await asyncio.to_thread(self.service.get_team_members, team_name)
 
         if not members:
             await update.effective_message.reply_text(f"Team '{team_name}' has no members!")
@@ -315,9 +402,29 @@ For users to be added to teams, they should:
         member_list = "\n".join(f"• @{member}" for member in members)
         await update.effective_message.reply_text(f"Members of team '{team_name}':\n{member_list}")
 
+    async def post_init(self, application: Application) -> None:
+        """Start background tasks once the event loop is running"""
+        self._flush_task = asyncio.create_task(self._flush_loop())
+        self._optimize_task = asyncio.create_task(self._optimize_loop())
+
+    async def post_shutdown(self, application: Application) -> None:
+        """Persist buffered state, refresh query planner statistics and release the database"""
+        for task in (self._flush_task, self._optimize_task):
+            if task:
+                task.cancel()
+        await self.flush_user_cache()
+        self.service.db.optimize()
+        self.service.db.close()
+
     def run(self) -> NoReturn:
         """Start the bot"""
-        application = Application.builder().token(self.token).build()
+        application = (
+            Application.builder()
+            .token(self.token)
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
+            .build()
+        )
 
         # Add command handlers
         application.add_handler(CommandHandler("start", self.start))